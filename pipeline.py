@@ -0,0 +1,475 @@
+import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+import re
+import array
+import json
+import hashlib
+import itertools
+import collections
+import queue
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from google.cloud import speech, texttospeech
+import tempfile
+import shutil
+import io
+from fractions import Fraction
+import av
+import requests
+from requests.adapters import HTTPAdapter
+import os
+
+# Keep intermediate files in RAM-backed tmpfs when it has room for them, unless TMPDIR is set
+if "TMPDIR" not in os.environ and os.path.isdir("/dev/shm") and shutil.disk_usage("/dev/shm").free >= 1 << 30:
+    tempfile.tempdir = "/dev/shm"
+
+# Sample rate of the PCM audio sent to Google STT
+SAMPLE_RATE = 16000
+
+# Uploads are always mp4/mov/avi, so libavformat only needs a short probe to identify their streams;
+# genpts fills in the timestamps AVI lacks so its video can be stream-copied
+VIDEO_INPUT_OPTIONS = {"probesize": "1000000", "analyzeduration": "1000000", "fflags": "+genpts"}
+
+# Pin the STT model rather than relying on the region default; latest_short would end the
+# stream at the first pause, which suits voice commands but not the audio track of a video
+STT_MODEL = "latest_long"
+
+# Audio is recognized in one-minute segments, each on its own stream, so segments can be
+# transcribed in parallel and stay well under Google's ~5 minute streaming limit
+SEGMENT_SECONDS = 60
+
+# Each segment ends at the quietest 100 ms in its last few seconds, so cuts fall in pauses
+# between words rather than in the middle of one
+SEGMENT_CUT_SECONDS = 5
+
+# Segments buffered between pipeline stages before the producing stage waits for its consumer
+STAGE_QUEUE_SIZE = 4
+
+# Google TTS voice used for the replacement audio (adjust this to use the desired voice)
+TTS_VOICE = "en-AU-Standard-B"
+
+# Short TTS requests return sooner and can be issued in parallel
+TTS_CHUNK_CHARS = 200
+
+# Transcription, correction and synthesis results are reused for a week across reruns and sessions.
+# The caches stay in memory: Streamlit never deletes persisted entries, so a disk cache would grow
+# without bound
+CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+CACHE_MAX_ENTRIES = 512
+
+
+@st.cache_resource(show_spinner=False)
+def get_stt_client():
+    """Returns a Speech-to-Text client shared across reruns and sessions."""
+    return speech.SpeechClient()
+
+@st.cache_resource(show_spinner=False)
+def get_tts_client():
+    """Returns a Text-to-Speech client shared across reruns and sessions."""
+    return texttospeech.TextToSpeechClient()
+
+@st.cache_resource(show_spinner=False)
+def get_azure_session():
+    """Returns an HTTP session that keeps connections to the Azure endpoint alive between calls."""
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16))
+    return session
+
+def extract_audio_from_video(video_path):
+    """Decodes the video's audio track to mono 16-bit PCM, yielding ~100 ms chunks."""
+    chunk_size = SAMPLE_RATE // 10 * 2
+    resampler = av.AudioResampler(format="s16", layout="mono", rate=SAMPLE_RATE)
+    pcm = bytearray()
+    with av.open(video_path, options=VIDEO_INPUT_OPTIONS) as container:
+        # Only audio packets are decoded; the trailing None flushes the resampler
+        for frame in itertools.chain(container.decode(audio=0), [None]):
+            for resampled in resampler.resample(frame):
+                # The plane buffer is padded, so copy only the samples it actually holds
+                pcm += memoryview(resampled.planes[0])[:resampled.samples * 2]
+            while len(pcm) >= chunk_size:
+                yield bytes(pcm[:chunk_size])
+                del pcm[:chunk_size]
+    if pcm:
+        yield bytes(pcm)
+
+def encode_flac(pcm):
+    """Compresses mono 16-bit PCM at SAMPLE_RATE into a FLAC stream."""
+    buffer = io.BytesIO()
+    with av.open(buffer, "w", format="flac") as container:
+        stream = container.add_stream("flac", rate=SAMPLE_RATE, layout="mono")
+        stream.format = "s16"
+        frame = av.AudioFrame(format="s16", layout="mono", samples=len(pcm) // 2)
+        frame.planes[0].update(pcm)
+        frame.sample_rate = SAMPLE_RATE
+        for packet in itertools.chain(stream.encode(frame), stream.encode(None)):
+            container.mux(packet)
+    return buffer.getvalue()
+
+def chunk_energy(chunk):
+    """Returns the sum of squared samples of a 16-bit PCM chunk."""
+    return sum(sample * sample for sample in array.array("h", chunk))
+
+def split_at_pauses(chunks):
+    """Groups ~100 ms PCM chunks into segments of at most SEGMENT_SECONDS.
+
+    Each full segment is cut after the quietest chunk in its last SEGMENT_CUT_SECONDS (at
+    most its second half), and the chunks after the cut carry over into the next segment.
+    """
+    segment = []
+    for chunk in chunks:
+        segment.append(chunk)
+        if len(segment) == SEGMENT_SECONDS * 10:
+            candidates = range(max(len(segment) - SEGMENT_CUT_SECONDS * 10, len(segment) // 2), len(segment))
+            cut = min(candidates, key=lambda i: chunk_energy(segment[i])) + 1
+            yield b"".join(segment[:cut])
+            segment = segment[cut:]
+    if segment:
+        yield b"".join(segment)
+
+class StageFailed(Exception):
+    """Raised by a pipeline stage after it has already reported its error to the user."""
+
+@st.cache_data(ttl=CACHE_TTL_SECONDS, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def request_stream_transcript(upload_hash, stream_index, segment_seconds, cut_seconds, model, _segment_pcm):
+    """Transcribes one audio segment over a Google STT stream.
+
+    Results are cached by upload hash and position; the segmenting parameters and model are
+    part of the key because Streamlit doesn't hash the module constants they come from.
+    """
+    config = speech.RecognitionConfig(
+        encoding=speech.RecognitionConfig.AudioEncoding.FLAC,
+        sample_rate_hertz=SAMPLE_RATE,
+        language_code="en-US",
+        model=model,
+        # Punctuation gives correction and synthesis sentence boundaries to split at
+        enable_automatic_punctuation=True,
+    )
+    streaming_config = speech.StreamingRecognitionConfig(config=config, interim_results=False)
+
+    # FLAC is lossless and roughly halves the bytes uploaded for speech
+    audio = encode_flac(_segment_pcm)
+    responses = get_stt_client().streaming_recognize(
+        config=streaming_config,
+        requests=(speech.StreamingRecognizeRequest(audio_content=audio[i:i + 8192]) for i in range(0, len(audio), 8192)),
+    )
+    return " ".join(result.alternatives[0].transcript for response in responses for result in response.results)
+
+def transcribe_audio(video_path, upload_hash):
+    """Transcribes the audio track of a video using Google Speech-to-Text streaming recognition.
+
+    Segments are recognized concurrently and their transcripts yielded in order.
+    """
+    try:
+        # Closing the decoder on exit releases the container if recognition fails part way through
+        with contextlib.closing(extract_audio_from_video(video_path)) as chunks, thread_pool(8) as recognition_pool:
+            pending = collections.deque()
+            for stream_index, segment_pcm in enumerate(split_at_pauses(chunks)):
+                pending.append(recognition_pool.submit(
+                    request_stream_transcript, upload_hash, stream_index, SEGMENT_SECONDS, SEGMENT_CUT_SECONDS, STT_MODEL, segment_pcm
+                ))
+                # Hand finished segments downstream early and bound the audio buffered in memory
+                while pending and (pending[0].done() or len(pending) >= 8):
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+    except Exception as e:
+        st.error(f"Error during transcription: {e}")
+        raise StageFailed from e
+
+
+@st.cache_data(ttl=CACHE_TTL_SECONDS, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def request_correction(chunks, api_url, _api_key):
+    """Sends transcript chunks to Azure OpenAI GPT-4o; results are cached by chunk content and endpoint."""
+    headers = {"Content-Type": "application/json", "api-key": _api_key}
+    data = {
+        "messages": [
+            {"role": "system", "content": "Please correct each transcript chunk. The corrections should not say anything other than given in the transcript and dont alter the transcript. "
+                                          "Reply with a JSON object {\"chunks\": [...]} holding one corrected string per input chunk, in the same order."},
+            {"role": "user", "content": json.dumps({"chunks": chunks})},
+        ],
+        "response_format": {"type": "json_object"},
+    }
+    response = get_azure_session().post(api_url, headers=headers, json=data, timeout=120)
+    
+    # Check for a successful response and expected content
+    if response.status_code != 200:
+        raise RuntimeError(f"Error from Azure API: {response.status_code} - {response.text}")
+    response_data = response.json()
+    if 'choices' not in response_data or len(response_data['choices']) == 0:
+        raise RuntimeError("Unexpected response format from Azure OpenAI.")
+    corrected_chunks = json.loads(response_data['choices'][0]['message']['content']).get("chunks")
+    if not isinstance(corrected_chunks, list) or len(corrected_chunks) != len(chunks) \
+            or not all(isinstance(chunk, str) for chunk in corrected_chunks):
+        raise RuntimeError("Azure OpenAI did not return one corrected string per transcript chunk.")
+    return corrected_chunks
+
+def correct_transcription(chunks, api_url, api_key):
+    """Corrects transcript chunks using Azure OpenAI GPT-4o in a single request.
+
+    Returns the corrected chunks in the same order as the input chunks.
+    """
+    try:
+        return request_correction(chunks, api_url, api_key)
+    except Exception as e:
+        st.error(f"Error during transcription correction: {e}")
+        return None
+
+
+@st.cache_data(ttl=CACHE_TTL_SECONDS, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def request_speech(text, voice_name):
+    """Synthesizes text with Google Text-to-Speech; results are cached by text and voice."""
+    client = get_tts_client()
+    input_text = texttospeech.SynthesisInput(text=text)
+    voice = texttospeech.VoiceSelectionParams(language_code="en-US", name=voice_name)
+    audio_config = texttospeech.AudioConfig(audio_encoding=texttospeech.AudioEncoding.MP3)
+    
+    response = client.synthesize_speech(input=input_text, voice=voice, audio_config=audio_config)
+    return response.audio_content
+
+def synthesize_speech(text):
+    """Synthesizes speech from text using Google Text-to-Speech API.
+
+    The text is split into short sentence chunks that are synthesized concurrently, and
+    the MP3 parts are yielded in order as soon as each one is ready. Raises StageFailed
+    if synthesis failed.
+    """
+    try:
+        with thread_pool(8) as synthesis_pool:
+            futures = [
+                synthesis_pool.submit(request_speech, chunk, TTS_VOICE)
+                for chunk in split_into_sentences(text, max_chars=TTS_CHUNK_CHARS)
+            ]
+            for future in futures:
+                yield future.result()
+    except Exception as e:
+        st.error(f"Error during text-to-speech synthesis: {e}")
+        raise StageFailed from e
+
+def split_into_sentences(text, max_chars=1000):
+    """Splits text into chunks of at most max_chars characters.
+
+    Chunks break at sentence boundaries, and sentences longer than max_chars break between
+    words; only a single word longer than max_chars makes a longer chunk.
+    """
+    pieces = []
+    for sentence in re.split(r"(?<=[.!?])\s+", text.strip()):
+        pieces.extend(sentence.split() if len(sentence) > max_chars else [sentence])
+    chunks = []
+    current = ""
+    for piece in pieces:
+        if current and len(current) + len(piece) + 1 > max_chars:
+            chunks.append(current)
+            current = piece
+        else:
+            current = f"{current} {piece}".strip()
+    if current:
+        chunks.append(current)
+    return chunks
+
+def thread_pool(max_workers):
+    """Creates a thread pool whose workers can report errors through Streamlit."""
+    ctx = get_script_run_ctx()
+    return ThreadPoolExecutor(max_workers=max_workers, initializer=add_script_run_ctx, initargs=(None, ctx))
+
+def run_in_background(items):
+    """Iterates items on a background thread and yields them as they become available.
+
+    The bounded queue applies backpressure, so the producing stage never runs more than
+    STAGE_QUEUE_SIZE items ahead of its consumer. Closing the returned generator stops
+    the producer.
+    """
+    results = queue.Queue(maxsize=STAGE_QUEUE_SIZE)
+    stopped = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def produce():
+        try:
+            for item in items:
+                if stopped.is_set():
+                    break
+                put((None, item))
+            put((None, done))
+        except Exception as e:
+            put((e, None))
+        finally:
+            if hasattr(items, "close"):
+                items.close()
+
+    worker = threading.Thread(target=produce, daemon=True)
+    add_script_run_ctx(worker, get_script_run_ctx())
+    worker.start()
+    try:
+        while True:
+            error, item = results.get()
+            if error:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stopped.set()
+
+def correct_segment(segment, api_url, api_key):
+    """Corrects one transcript segment, raising StageFailed if the correction failed."""
+    chunks = split_into_sentences(segment)
+    if not chunks:
+        return ""
+    corrected_chunks = correct_transcription(chunks, api_url, api_key)
+    if corrected_chunks is None:
+        raise StageFailed
+    return " ".join(corrected_chunks)
+
+@st.cache_resource(show_spinner=False)
+def has_nvenc():
+    """Checks once per process whether the NVENC H.264 encoder can be opened on this machine."""
+    try:
+        codec_context = av.CodecContext.create("h264_nvenc", "w")
+        codec_context.width = codec_context.height = 256
+        codec_context.pix_fmt = "yuv420p"
+        codec_context.time_base = Fraction(1, 25)
+        codec_context.open()
+        return True
+    except (av.FFmpegError, ValueError):
+        return False
+
+class IterableReader(io.RawIOBase):
+    """Exposes an iterable of byte strings as a readable, non-seekable file."""
+
+    def __init__(self, parts):
+        self.parts = iter(parts)
+        self.pending = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending:
+            try:
+                self.pending = memoryview(next(self.parts))
+            except StopIteration:
+                return 0
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+def copy_packets(container, stream, output_stream):
+    """Demuxes a stream's packets and retargets them at an output stream without decoding."""
+    for packet in container.demux(stream):
+        # Skip the empty packet that marks the end of the stream
+        if packet.dts is None:
+            continue
+        packet.stream = output_stream
+        yield packet
+
+def encode_packets(container, stream, output_stream):
+    """Decodes a stream's frames and re-encodes them with the output stream's encoder."""
+    for frame in container.decode(stream):
+        yield from output_stream.encode(frame)
+    yield from output_stream.encode(None)
+
+def interleave(video, audio):
+    """Merges video and audio packet streams in presentation order for the length of the video.
+
+    Once the audio runs out the remaining video packets are passed through on their own,
+    and audio that runs past the end of the video is dropped.
+    """
+    video_packet = next(video, None)
+    audio_packet = next(audio, None)
+    while video_packet is not None:
+        if audio_packet is not None and audio_packet.dts * audio_packet.time_base < video_packet.dts * video_packet.time_base:
+            yield audio_packet
+            audio_packet = next(audio, None)
+        else:
+            yield video_packet
+            video_packet = next(video, None)
+
+def replace_audio_in_video(video_path, audio_parts):
+    """Replaces the audio in the video with new audio content.
+
+    ``audio_parts`` is an iterable of MP3 byte strings that is demuxed as it is produced
+    and copied into the MP4 as-is. The video track is stream-copied when MP4 can hold its
+    codec, and otherwise encoded with NVENC when available and libx264 otherwise.
+    The output keeps the full length of the video, even when the speech ends earlier.
+    """
+    output_path = tempfile.NamedTemporaryFile(delete=False, suffix=".mp4").name
+    try:
+        # Write the moov atom up front so the result plays progressively in browsers
+        with av.open(video_path, options=VIDEO_INPUT_OPTIONS) as video_input, \
+                av.open(IterableReader(audio_parts), format="mp3") as audio_input, \
+                av.open(output_path, "w", format="mp4", options={"movflags": "+faststart"}) as output:
+            input_video = video_input.streams.video[0]
+            input_audio = audio_input.streams.audio[0]
+
+            if input_video.codec_context.name in output.supported_codecs:
+                # Stream-copy the video track, so neither track is re-encoded
+                output_video = output.add_stream_from_template(input_video)
+                video_packets = copy_packets(video_input, input_video, output_video)
+            else:
+                # Codecs MP4 can't hold, such as DivX 3 in AVI uploads, have to be re-encoded
+                if has_nvenc():
+                    output_video = output.add_stream("h264_nvenc", rate=input_video.average_rate, options={"preset": "p4", "rc": "vbr", "cq": "23"})
+                else:
+                    output_video = output.add_stream("libx264", rate=input_video.average_rate, options={"preset": "veryfast"})
+                output_video.width = input_video.codec_context.width
+                output_video.height = input_video.codec_context.height
+                output_video.pix_fmt = "yuv420p"
+                video_packets = encode_packets(video_input, input_video, output_video)
+
+            output_audio = output.add_stream_from_template(input_audio)
+            audio_packets = copy_packets(audio_input, input_audio, output_audio)
+            for packet in interleave(video_packets, audio_packets):
+                output.mux(packet)
+        
+        return output_path
+    except StageFailed:
+        os.remove(output_path)
+        return None
+    except Exception as e:
+        os.remove(output_path)
+        st.error(f"Error during video processing: {e}")
+        return None
+
+def dub_video(video_path, upload_hash, azure_api_url, azure_api_key):
+    """Transcribes, corrects, re-synthesizes and remuxes a video as overlapping stages.
+
+    Each stage runs on its own thread and passes results on one audio segment at a time;
+    synthesized audio is passed on per sentence, so the muxer starts receiving audio as
+    soon as the first sentence is ready.
+    Returns the output path, or None if any stage failed.
+    """
+    segments = run_in_background(transcribe_audio(video_path, upload_hash))
+    corrected_segments = run_in_background(
+        correct_segment(segment, azure_api_url, azure_api_key) for segment in segments
+    )
+    # MP3 frames are self-contained, so the sentence parts can be concatenated as-is
+    audio_parts = run_in_background(itertools.chain.from_iterable(map(synthesize_speech, corrected_segments)))
+    try:
+        # A silent video or an empty transcript gives no speech, which the MP3 demuxer can't open
+        first_part = next(audio_parts, None)
+        if first_part is None:
+            st.error("No speech was found in the video.")
+            return None
+        return replace_audio_in_video(video_path, itertools.chain([first_part], audio_parts))
+    except StageFailed:
+        return None
+    finally:
+        audio_parts.close()
+
+def save_upload(uploaded_file):
+    """Copies an upload to a temporary file in 1 MiB blocks and returns its path and SHA-256 digest."""
+    digest = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".mp4") as temp_video:
+        for block in iter(lambda: uploaded_file.read(1 << 20), b""):
+            digest.update(block)
+            temp_video.write(block)
+    return temp_video.name, digest.hexdigest()